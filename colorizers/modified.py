@@ -1,11 +1,17 @@
 
+from pathlib import Path
+import numpy as np
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from .layers import build_basic_block
 from .base_color import *
 
+BUCKETS_PATH = Path(__file__).resolve().parents[1] / "resources" / "buckets_313.npy"
+
 # REVIEW(Rudy) - are the additional layers being added at the right place
 class ModifiedColorizer(BaseColor):
-    def __init__(self, config):
+    def __init__(self, config, buckets_path=BUCKETS_PATH):
         super(ModifiedColorizer, self).__init__()
 
         dropoutLayers = config.dropoutLayers
@@ -33,7 +39,7 @@ class ModifiedColorizer(BaseColor):
               newLayer = build_basic_block(channels=[512 * channelMultiplier] * 4, kernel_size=3)
               additional.append(newLayer)
 
-        self.additional_layers = nn.ModuleList(additional)
+        self.additional_layers = nn.Sequential(*additional)
 
         self.model8 = build_basic_block(
               channels=[512 * channelMultiplier, 256 * channelMultiplier, 256 * channelMultiplier, 256 * channelMultiplier], kernel_size=[4, 3, 3], stride=[2, 1, 1], 
@@ -51,7 +57,14 @@ class ModifiedColorizer(BaseColor):
               dropout=dropoutLayers[9]
         )
         self.model10.append(nn.Conv2d(64 * channelMultiplier, 313, kernel_size=1, stride=1, padding=0, bias=True))
-        self.softmax = nn.Softmax(dim=1)
+
+        # ab value of each output bin, used by predict_ab. CIELabConversion numbers
+        # buckets from 1, so bin c >= 1 is buckets[c - 1] and bin 0 is unused (mapped
+        # to ab = 0). Not persisted in the state dict.
+        buckets = np.load(buckets_path)
+        ab_bins = np.zeros_like(buckets, dtype=np.float32)
+        ab_bins[1:] = buckets[:-1]
+        self.register_buffer('ab_bins', torch.from_numpy(ab_bins), persistent=False)
 
     def forward(self, input_l):
         conv1_2 = self.model1(self.normalize_l(input_l))
@@ -63,14 +76,21 @@ class ModifiedColorizer(BaseColor):
         conv7_3 = self.model7(conv6_3)
 
         # apply additional layers
-        for layer in self.additional_layers:
-            conv7_3 = layer(conv7_3)
+        conv7_3 = self.additional_layers(conv7_3)
 
         conv8_3 = self.model8(conv7_3)
         conv9_3 = self.model9(conv8_3)
         conv10_3 = self.model10(conv9_3)
-        out_reg = self.softmax(conv10_3)
-        return out_reg
+        # return logits, nn.CrossEntropyLoss applies log-softmax itself
+        return conv10_3
+
+    def predict(self, input_l):
+        return F.softmax(self(input_l), dim=1)
+
+    def predict_ab(self, input_l):
+        # point estimate of ab from the most likely bin, softmax is not needed for argmax
+        bins = self(input_l).argmax(dim=1)
+        return self.ab_bins[bins].permute(0, 3, 1, 2)
 
 def modified_colorizer(config):
 	model = ModifiedColorizer(config)
@@ -70,7 +70,8 @@ def create_dataset(
         )
         imsave(color_image_output, img_as_ubyte(image))
 
-        np.save(bucket_label_output, cielab.get_image_ab_buckets(rgb2lab(image)))
+        # 313 buckets fit in uint16, a quarter of the default int64 on disk
+        np.save(bucket_label_output, cielab.get_image_ab_buckets(rgb2lab(image)).astype(np.uint16))
 
         # Convert from float grayscale format to uint 0-255 format
         # NOTE: this changes the values ever so slightly but is not significant
@@ -1,9 +1,11 @@
 
+import json
 import os
 import typing as T
 
 import numpy as np
-from skimage.io import imread
+import torch
+from PIL import Image
 from torch.utils.data import Dataset
 
 class ColorizationDataset(Dataset):
@@ -13,6 +15,10 @@ class ColorizationDataset(Dataset):
         grayscale_name_prefix: str = "gray",
         # color_name_prefix: str = "color",
         bucket_label_prefix: str = "bucket",
+        label_shard_name: str = "labels.npy",
+        label_index_name: str = "index.json",
+        grayscale_shard_name: str = "gray.npy",
+        grayscale_index_name: str = "gray_index.json",
         resize_image_size: T.Union[T.Tuple[int, int], None] = (256, 256)
     ) -> None:
         self.grayscale_name_prefix = grayscale_name_prefix
@@ -24,27 +30,124 @@ class ColorizationDataset(Dataset):
         self.bucket_path = os.path.join(dataset_path, bucket_label_prefix)
 
         # NOTE: This may need to change if we can't load all filenames in memory
-        self.grayscale_images = os.listdir(self.grayscale_path)
+        grayscale_images = os.listdir(self.grayscale_path)
         # self.color_images = os.listdir(self.color_path)
         self.bucket_labels = os.listdir(self.bucket_path)
 
+        # Pair each grayscale image with its label filename once. Stored as numpy string
+        # arrays rather than lists so indexing doesn't touch a Python object per sample
+        # (which also avoids copy-on-write of the lists in forked DataLoader workers)
+        self.grayscale_images = np.array(grayscale_images)
+        self.bucket_label_names = np.array([
+            self._bucket_label_name(grayscale_image) for grayscale_image in grayscale_images
+        ])
+
+        # Use the stacked shards from shards.py if they have been generated, otherwise
+        # fall back to loading one file per sample. Shards are memory-mapped lazily in
+        # each process, see _open_shard
+        self._shards = {}
+        self.label_shard_path, self.label_rows = self._load_shard(
+            dataset_path, label_shard_name, label_index_name, self.bucket_label_names)
+        self.grayscale_shard_path, self.grayscale_rows = self._load_shard(
+            dataset_path, grayscale_shard_name, grayscale_index_name, self.grayscale_images)
+
         self.resize_image_size = resize_image_size
+        if resize_image_size is not None:
+            self._check_image_size(resize_image_size)
+
+    def _check_image_size(self, image_size: T.Tuple[int, int]) -> None:
+        """
+        Images are resized once by data_generation.py rather than every epoch, so make
+        sure the dataset was generated at the expected size.
+        """
+        if len(self.grayscale_images) == 0:
+            return
+        if self.grayscale_shard_path is not None:
+            # only the .npy header is read, the memmap is discarded
+            shape = np.load(self.grayscale_shard_path, mmap_mode="r").shape[1:]
+        else:
+            with Image.open(os.path.join(self.grayscale_path, self.grayscale_images[0])) as image:
+                shape = (image.height, image.width)
+        if tuple(shape) != tuple(image_size):
+            raise ValueError(
+                f"Dataset images are {tuple(shape)} but {tuple(image_size)} was expected, "
+                "regenerate the dataset with data_generation.py --resize-image-size"
+            )
+
+    def _bucket_label_name(self, grayscale_image: str) -> str:
+        # There's probably a better way to do this
+        return (self.bucket_label_prefix +
+                "_" +
+                grayscale_image.removeprefix(self.grayscale_name_prefix + "_"))[:-4] + ".npy"
+
+    @staticmethod
+    def _load_shard(
+        dataset_path: str, shard_name: str, index_name: str, filenames: np.ndarray
+    ) -> T.Tuple[T.Union[str, None], T.Union[np.ndarray, None]]:
+        """
+        Return the path of a shard and the shard row of each filename. Raise if the shard
+        is out of date with the per-file dataset.
+        """
+        shard_path = os.path.join(dataset_path, shard_name)
+        index_path = os.path.join(dataset_path, index_name)
+        if not (os.path.exists(shard_path) and os.path.exists(index_path)):
+            return None, None
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        # only the .npy header is read here, the memmap is discarded
+        n_rows = len(np.load(shard_path, mmap_mode="r"))
+
+        missing = [filename for filename in filenames if filename not in index]
+        if len(index) != len(filenames) or n_rows != len(index) or missing:
+            raise ValueError(
+                f"{shard_name} is out of date with the dataset at {dataset_path} "
+                f"({n_rows} shard rows, {len(index)} indexed files, {len(filenames)} "
+                f"files on disk, {len(missing)} missing from the index), "
+                "rerun dataset/shards.py"
+            )
+        rows = np.array([index[filename] for filename in filenames], dtype=np.int64)
+        return shard_path, rows
+
+    def _open_shard(self, shard_path: str) -> np.ndarray:
+        if shard_path not in self._shards:
+            self._shards[shard_path] = np.load(shard_path, mmap_mode="r")
+        return self._shards[shard_path]
+
+    def __getstate__(self) -> T.Dict[str, T.Any]:
+        # A memmap pickles as a full in-memory copy of its data, so spawned DataLoader
+        # workers reopen the shards themselves instead
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def _read_grayscale(self, path: str) -> np.ndarray:
+        """
+        Decode an image as a uint8 grayscale array.
+        """
+        with Image.open(path) as image:
+            return np.array(image.convert("L"))
 
     def __len__(self) -> int:
         return len(self.grayscale_images)
 
-    def __getitem__(self, index: int) -> T.Tuple[np.ndarray, np.ndarray]:
-        grayscale_image_path = self.grayscale_images[index]
-        
-        # There's probably a better way to do this
-        bucket_label_path = (self.bucket_label_prefix +
-                             "_" +
-                             grayscale_image_path.removeprefix(self.grayscale_name_prefix + "_"))[:-4] + ".npy"
-        
-        grayscale_image = imread(os.path.join(self.grayscale_path, grayscale_image_path), as_gray=True)
+    def __getitem__(self, index: int) -> T.Tuple[np.ndarray, torch.Tensor]:
+        if self.grayscale_shard_path is not None:
+            grayscale = self._open_shard(self.grayscale_shard_path)
+            grayscale_image = np.array(grayscale[self.grayscale_rows[index]])
+        else:
+            grayscale_image = self._read_grayscale(
+                os.path.join(self.grayscale_path, self.grayscale_images[index]))
 
-        bucket_ids = np.load(os.path.join(self.bucket_path, bucket_label_path))
+        if self.label_shard_path is not None:
+            labels = self._open_shard(self.label_shard_path)
+            bucket_ids = np.array(labels[self.label_rows[index]])
+        else:
+            bucket_ids = np.load(os.path.join(self.bucket_path, self.bucket_label_names[index]))
 
         # TODO: Preprocessing
 
-        return (grayscale_image, bucket_ids)
\ No newline at end of file
+        # Labels stay 16-bit until they reach the device. Viewed as int16 (bucket ids are
+        # < 2**15) since torch has limited uint16 support
+        bucket_ids = bucket_ids.astype(np.uint16, copy=False).view(np.int16)
+
+        return (grayscale_image, torch.from_numpy(bucket_ids))
\ No newline at end of file
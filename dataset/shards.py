@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+import typing as T
+
+
+def _stack_into_shard(
+    input_path: str,
+    shard_path: str,
+    index_path: str,
+    load_fn: T.Callable[[str], np.ndarray],
+    dtype: T.Type[np.integer]
+) -> None:
+    """
+    Stack every file of a directory into a single (N, ...) .npy array, written through
+    a memmap so the whole dataset never has to fit in memory. Also writes a JSON index
+    mapping filename to row.
+    """
+    filenames = sorted(os.listdir(input_path))
+    if not filenames:
+        print(f"No files found in {input_path}.")
+        return
+
+    shape = load_fn(os.path.join(input_path, filenames[0])).shape
+    shard = np.lib.format.open_memmap(shard_path, mode="w+", dtype=dtype,
+                                      shape=(len(filenames), *shape))
+    for row, filename in enumerate(tqdm(filenames)):
+        shard[row] = load_fn(os.path.join(input_path, filename))
+    shard.flush()
+
+    with open(index_path, "w") as index_file:
+        json.dump({filename: row for row, filename in enumerate(filenames)}, index_file)
+
+
+def create_label_shard(
+    dataset_path: str,
+    bucket_label_prefix: str = "bucket",
+    shard_name: str = "labels.npy",
+    index_name: str = "index.json",
+    dtype: T.Type[np.integer] = np.uint16
+) -> None:
+    """
+    Stack every per-image bucket label file of a generated dataset into a single
+    (N, H, W) array so ColorizationDataset can memory-map it instead of opening one
+    .npy file per sample. Also writes an index mapping label filename to row.
+
+    313 buckets fit in 9 bits, so labels are stored as uint16 by default.
+    """
+    _stack_into_shard(os.path.join(dataset_path, bucket_label_prefix),
+                      os.path.join(dataset_path, shard_name),
+                      os.path.join(dataset_path, index_name),
+                      np.load,
+                      dtype)
+
+
+def create_grayscale_shard(
+    dataset_path: str,
+    grayscale_name_prefix: str = "gray",
+    shard_name: str = "gray.npy",
+    index_name: str = "gray_index.json"
+) -> None:
+    """
+    Decode every (already resized) grayscale image of a generated dataset once and
+    stack them into a single uint8 (N, H, W) array, so ColorizationDataset can slice
+    rows from a memory-map instead of decoding an image per sample every epoch.
+    """
+    def load_grayscale(path: str) -> np.ndarray:
+        with Image.open(path) as image:
+            return np.asarray(image.convert("L"))
+
+    _stack_into_shard(os.path.join(dataset_path, grayscale_name_prefix),
+                      os.path.join(dataset_path, shard_name),
+                      os.path.join(dataset_path, index_name),
+                      load_grayscale,
+                      np.uint8)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset_path", help="Path to a dataset created by data_generation.py")
+    parser.add_argument("-g", "--gray_prefix", default="gray",
+                        help="Name prefix for grayscale images")
+    parser.add_argument("-b", "--bucket_prefix", default="bucket",
+                        help="Name prefix for image bucket labels")
+    parser.add_argument("--shard_name", default="labels.npy",
+                        help="Filename of the stacked label array")
+    parser.add_argument("--index_name", default="index.json",
+                        help="Filename of the label filename to row index")
+    parser.add_argument("--gray_shard_name", default="gray.npy",
+                        help="Filename of the stacked grayscale image array")
+    parser.add_argument("--gray_index_name", default="gray_index.json",
+                        help="Filename of the grayscale filename to row index")
+    args = parser.parse_args()
+
+    create_label_shard(args.dataset_path,
+                       args.bucket_prefix,
+                       args.shard_name,
+                       args.index_name)
+    create_grayscale_shard(args.dataset_path,
+                           args.gray_prefix,
+                           args.gray_shard_name,
+                           args.gray_index_name)
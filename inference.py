@@ -0,0 +1,27 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from torch.utils.data import DataLoader
+from train import gray_to_l
+
+def quantize_for_inference(
+    net: nn.Module, dataloader: DataLoader, n_calibration_batches: int = 10
+) -> nn.Module:
+    """
+    Return an INT8 copy of a model for CPU inference, using FX graph mode post-training
+    quantization (per-channel qint8 weights, per-tensor quint8 activations). Activation
+    ranges are calibrated on the first few batches of a dataloader.
+    """
+    net = copy.deepcopy(net).to('cpu', memory_format=torch.channels_last).eval()
+    example_inputs = (torch.zeros(1, 1, 256, 256).to(memory_format=torch.channels_last),)
+    prepared = prepare_fx(net, get_default_qconfig_mapping('x86'), example_inputs)
+    with torch.no_grad():
+        for i, data in enumerate(dataloader):
+            if i >= n_calibration_batches:
+                break
+            rs_l, _ = data
+            inputs = rs_l[:, None, :, :].to(memory_format=torch.channels_last)
+            prepared(gray_to_l(inputs))
+    return convert_fx(prepared)
@@ -4,7 +4,7 @@ import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from colorizers.generator import ModelConfig, generate_model
-from train import build_optimizer, build_criterion, train, TrainingLogger, get_dataloader
+from train import build_optimizer, build_criterion, compile_model, train, TrainingLogger, get_dataloader
 from utils import get_device, get_root_dir
 
 class MSPipeline:
@@ -26,7 +26,9 @@ class MSPipeline:
         best_model_config = None
         for model_config in self.models_config:
             model = generate_model(model_config)
-            model.to(device)
+            # channels_last lets cuDNN/oneDNN pick NHWC conv kernels directly
+            model.to(device, memory_format=torch.channels_last)
+            model = compile_model(model)
             optimizer = build_optimizer('Adam', {'params': model.parameters(), 'lr': 0.001})
             criterion = build_criterion('CrossEntropyLoss', {})
             logger = TrainingLogger()
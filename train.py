@@ -1,9 +1,9 @@
+import os
 from PIL import Image
 from pathlib import Path
 import typing as T
 import numpy as np
 import torch
-from skimage import color
 from torch import Tensor
 from torch.optim import Optimizer
 import torch.nn as nn
@@ -14,41 +14,82 @@ from torch.utils.data import DataLoader
 from torchvision import transforms
 from dataset.dataset import ColorizationDataset
 
+# Inputs are a fixed (B, 1, 256, 256) shape, so let cuDNN autotune conv algorithms once
+# and allow TF32 for convs/matmuls
+torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
+
 def resize_img(img: Image, HW: T.Tuple[int, int] = (256,256), resample: int = 3) -> np.ndarray:
     """
     Resize an image to a given size.
     """
     return np.asarray(img.resize((HW[1],HW[0]), resample=resample))
 
+# sRGB (D65) to CIE XYZ, and the D65 reference white, matching skimage.color
+RGB_TO_XYZ = torch.tensor([
+    [0.412453, 0.357580, 0.180423],
+    [0.212671, 0.715160, 0.072169],
+    [0.019334, 0.119193, 0.950227],
+])
+XYZ_WHITE_D65 = torch.tensor([0.95047, 1., 1.08883])
+XYZ_TO_RGB = torch.linalg.inv(RGB_TO_XYZ)
+
+def rgb2lab_torch(img_rgb: Tensor) -> Tensor:
+    """
+    Convert a batch of sRGB images in [0, 1] to CIE Lab on the images' device.
+    """
+	# img_rgb 	B x 3 x H x W
+    rgb = torch.where(img_rgb > 0.04045, ((img_rgb + 0.055) / 1.055) ** 2.4, img_rgb / 12.92)
+    xyz = torch.einsum('ij,bjhw->bihw', RGB_TO_XYZ.to(rgb), rgb)
+    xyz = xyz / XYZ_WHITE_D65.to(rgb)[None, :, None, None]
+
+    f = torch.where(xyz > 0.008856, xyz.clamp(min=0.008856) ** (1. / 3.), 7.787 * xyz + 16. / 116.)
+    fx, fy, fz = f[:, 0], f[:, 1], f[:, 2]
+    return torch.stack((116. * fy - 16., 500. * (fx - fy), 200. * (fy - fz)), dim=1)
+
+def lab2rgb_torch(img_lab: Tensor) -> Tensor:
+    """
+    Convert a batch of CIE Lab images to sRGB in [0, 1] on the images' device.
+    """
+	# img_lab 	B x 3 x H x W
+    l, a, b = img_lab[:, 0], img_lab[:, 1], img_lab[:, 2]
+    fy = (l + 16.) / 116.
+    f = torch.stack((fy + a / 500., fy, (fy - b / 200.).clamp(min=0)), dim=1)
+    xyz = torch.where(f > 0.2068966, f ** 3, (f - 16. / 116.) / 7.787)
+    xyz = xyz * XYZ_WHITE_D65.to(xyz)[None, :, None, None]
+
+    rgb = torch.einsum('ij,bjhw->bihw', XYZ_TO_RGB.to(xyz), xyz)
+    rgb = torch.where(rgb > 0.0031308, 1.055 * rgb.clamp(min=0.0031308) ** (1. / 2.4) - 0.055, 12.92 * rgb)
+    return rgb.clamp(0, 1)
+
 def preprocess_img(
-        img_rgb_orig: Image, HW: T.Tuple[int, int] = (256,256), resample: int = 3
+        img_rgb_orig: Image, HW: T.Tuple[int, int] = (256,256), resample: int = 3,
+        device: T.Union[torch.device, None] = None
     ) -> T.Tuple[Tensor, Tensor, Tensor, Tensor]:
     """
-    Preprocess an image for training.
+    Preprocess an image for training. The Lab conversion runs on `device`.
     """
     # return original size L and resized L as torch Tensors
     img_rgb_rs = resize_img(img_rgb_orig, HW=HW, resample=resample)
-    img_lab_orig = color.rgb2lab(img_rgb_orig)
-    img_lab_rs = color.rgb2lab(img_rgb_rs)
+    tens_rgb_orig = torch.from_numpy(np.asarray(img_rgb_orig)).to(device).permute(2, 0, 1)[None]
+    tens_rgb_rs = torch.from_numpy(img_rgb_rs).to(device).permute(2, 0, 1)[None]
+    tens_lab_orig = rgb2lab_torch(tens_rgb_orig.float() / 255.)[0]
+    tens_lab_rs = rgb2lab_torch(tens_rgb_rs.float() / 255.)[0]
 
-    img_l_orig = img_lab_orig[:,:,0]
-    img_ab_orig = img_lab_orig[:,:,1:3]
+    tens_orig_l = tens_lab_orig[0:1]
+    tens_orig_ab = tens_lab_orig[1:3]
 
-    img_l_rs = img_lab_rs[:,:,0]
-    img_ab_rs = img_lab_rs[:,:,1:3]
-
-    tens_orig_l = torch.Tensor(img_l_orig)[None,:,:]
-    tens_orig_ab = torch.Tensor(img_ab_orig.transpose((2,0,1)))
-
-    tens_rs_l = torch.Tensor(img_l_rs)[None,:,:]
-    tens_rs_ab = torch.Tensor(img_ab_rs.transpose((2,0,1)))
-    tens_rs_ab = torch.randint(0, 313, (256, 256))
+    tens_rs_l = tens_lab_rs[0:1]
+    tens_rs_ab = tens_lab_rs[1:3]
 
     return tens_orig_l, tens_orig_ab, tens_rs_l, tens_rs_ab
 
 def postprocess_tens(tens_orig_l: Tensor, out_ab: Tensor, mode='bilinear') -> np.ndarray:
     """
-    Postprocess a tensor for visualization.
+    Postprocess a tensor for visualization. The Lab to RGB conversion runs on the
+    device of `out_ab`; only the final H x W x 3 image is copied to the host.
     """
 	# tens_orig_l 	1 x 1 x H_orig x W_orig
 	# out_ab 		1 x 2 x H x W
@@ -62,24 +103,58 @@ def postprocess_tens(tens_orig_l: Tensor, out_ab: Tensor, mode='bilinear') -> np
     else:
         out_ab_orig = out_ab
 
-    out_lab_orig = torch.cat((tens_orig_l, out_ab_orig), dim=1)
-    return color.lab2rgb(out_lab_orig.data.cpu().numpy()[0,...].transpose((1,2,0)))
+    out_lab_orig = torch.cat((tens_orig_l.to(out_ab_orig.device), out_ab_orig), dim=1)
+    out_rgb_orig = lab2rgb_torch(out_lab_orig.detach())
+    return out_rgb_orig[0].permute(1, 2, 0).cpu().numpy()
 
-def get_dataloader(data_path: str, batch_size: int = 8, num_workers: int = 0) -> DataLoader:
+def gray_to_l(gray: Tensor) -> Tensor:
+    """
+    Scale a uint8 grayscale tensor to the L channel range [0, 100].
+    """
+    return gray.float() * (100. / 255.)
+
+def get_dataloader(
+    data_path: str, batch_size: int = 8, num_workers: int = min(8, os.cpu_count() or 1),
+    pin_memory: bool = torch.cuda.is_available(), persistent_workers: bool = True, prefetch_factor: int = 4
+) -> DataLoader:
+    """
+    Build a shuffled DataLoader over a ColorizationDataset. Worker processes prefetch
+    batches into pinned memory so host-to-device copies can overlap with compute.
+    """
     transform = transforms.Compose([
         transforms.ToTensor(),
     ])
     dataset = ColorizationDataset(data_path)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+        pin_memory=pin_memory, persistent_workers=(num_workers > 0 and persistent_workers),
+        prefetch_factor=(prefetch_factor if num_workers > 0 else None)
+    )
     return dataloader
 
 
 def build_optimizer(type: str, args: T.Dict[str, T.Any]) -> Optimizer:
     """
-    Build an optimizer from a string and a set of arguments.
+    Build an optimizer from a string and a set of arguments. Adam, AdamW and SGD use
+    their fused multi-tensor CUDA step when all parameters live on the GPU.
     """
+    if type in {'Adam', 'AdamW', 'SGD'} and torch.cuda.is_available():
+        params = list(args['params'])
+        args = {**args, 'params': params}
+        if all(isinstance(p, Tensor) and p.is_cuda for p in params):
+            args.setdefault('fused', True)
     return getattr(torch.optim, type)(**args)
 
+def compile_model(net: nn.Module) -> nn.Module:
+    """
+    Compile a model in place with TorchInductor. Inputs are a fixed (B, 1, 256, 256)
+    shape, so the graph is specialized to static shapes.
+    """
+    torch._dynamo.config.cache_size_limit = 128
+    # nn.Module.compile keeps the state_dict keys free of the `_orig_mod.` prefix
+    net.compile(mode="max-autotune", fullgraph=True, backend="inductor", dynamic=False)
+    return net
+
 def build_criterion(type: str, args: T.Dict[str, T.Any]) -> nn.Module:
     """
     Build a criterion from a string and a set of arguments.
@@ -115,41 +190,59 @@ class TrainingLogger:
         plt.savefig(output_dir / f'{model_name}_loss.png')
 
 def eval(
-    net: nn.Module, dataloader: DataLoader, device: torch.device, criterion: nn.Module
+    net: nn.Module, dataloader: DataLoader, device: torch.device, criterion: nn.Module,
+    amp_dtype: torch.dtype = torch.bfloat16
 ) -> float:
     """
     Evaluate a model on a dataset using a given criterion. Return the average loss.
     """
+    device_type = torch.device(device).type
     net.eval()
-    with torch.no_grad():
-        running_loss = 0.0
+    with torch.no_grad(), torch.autocast(device_type=device_type, dtype=amp_dtype,
+                                         enabled=(device_type == 'cuda')):
+        running_loss = torch.zeros((), device=device)
         for data in dataloader:
             rs_l, rs_ab = data
             rs_l = rs_l[:, None, :, :]
             batch_size = rs_l.shape[0]
-            inputs = rs_l.to(device)
-            labels = rs_ab.type(torch.LongTensor).to(device)
+            inputs = gray_to_l(rs_l.to(device, memory_format=torch.channels_last, non_blocking=True))
+            labels = rs_ab.to(device, non_blocking=True).long()
             
             outputs = net(inputs)
             loss = criterion(outputs, labels)
-            running_loss += loss.item()/batch_size
-    return running_loss/len(dataloader)
+            running_loss += loss.detach()/batch_size
+    return running_loss.item()/len(dataloader)
 
 
 def train(
     net: nn.Module, optimizer: Optimizer, trainloader: DataLoader, testloader: DataLoader, 
-    device: torch.device, criterion: nn.Module, n_epochs: int, logger: TrainingLogger = None
+    device: torch.device, criterion: nn.Module, n_epochs: int, logger: TrainingLogger = None,
+    amp_dtype: torch.dtype = torch.bfloat16, sync_every: T.Union[int, None] = None
 ) -> T.Tuple[float, T.Dict[str, T.Any]]:
     """
     Train a model on a dataset using a given criterion and optimizer. Return the best
     evaluation loss and the best model parameters during training.
+
+    On CUDA the forward pass and loss run under autocast with `amp_dtype`. BF16 needs no
+    loss scaling; FP16 uses a GradScaler. CPU runs stay in FP32.
+
+    Losses are accumulated on the device and only copied to the host, and the progress
+    bar postfix only redrawn, every `sync_every` iterations (by default about 100 times
+    per epoch), so logging does not stall the GPU or write to the terminal each step.
     """
+    if sync_every is None:
+        sync_every = max(1, len(trainloader) // 100)
     best_eval_loss = np.inf
     best_model = None
 
+    device_type = torch.device(device).type
+    scaler = torch.amp.GradScaler('cuda', enabled=(amp_dtype == torch.float16 and device_type == 'cuda'))
+
     net.train()
     for epoch in range(n_epochs):
-        running_loss = 0.0
+        running_loss = torch.zeros((), device=device)
+        # per-iteration losses not yet copied to the host for the logger
+        pending_losses = []
         desc = 'Epoch %d/%d' % (epoch + 1, n_epochs)
         bar_fmt = '{l_bar}{bar}| [{elapsed}<{remaining}{postfix}]'
         with tqdm(desc=desc, total=len(trainloader), leave=True, miniters=1, unit='ex',
@@ -158,24 +251,34 @@ def train(
                 rs_l, rs_ab = data
                 rs_l = rs_l[:, None, :, :]
                 batch_size = rs_l.shape[0]
-                inputs = rs_l.to(device)
-                labels = rs_ab.type(torch.LongTensor).to(device)
+                inputs = gray_to_l(rs_l.to(device, memory_format=torch.channels_last, non_blocking=True))
+                labels = rs_ab.to(device, non_blocking=True).long()
 
-                optimizer.zero_grad()
-                outputs = net(inputs)
-                loss = criterion(outputs, labels)
-                loss.backward()
-                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+                with torch.autocast(device_type=device_type, dtype=amp_dtype,
+                                    enabled=(device_type == 'cuda')):
+                    outputs = net(inputs)
+                    loss = criterion(outputs, labels)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
                 # print statistics
-                iter_loss = loss.item()/batch_size
+                iter_loss = loss.detach()/batch_size
                 if logger is not None:
-                    logger.log_train_loss(i+1, iter_loss)
+                    pending_losses.append(iter_loss)
                 running_loss += iter_loss
-                progbar.set_postfix({'loss': '%.3g' % (running_loss / (i+1))})
+                if (i+1) % sync_every == 0 or i+1 == len(trainloader):
+                    if logger is not None:
+                        first = i+2 - len(pending_losses)
+                        for j, pending_loss in enumerate(torch.stack(pending_losses).tolist()):
+                            logger.log_train_loss(first + j, pending_loss)
+                        pending_losses.clear()
+                    progbar.set_postfix({'loss': '%.3g' % (running_loss.item() / (i+1))})
                 progbar.update(1)
-            
-            eval_loss = eval(net, testloader, device, criterion)
+            running_loss = running_loss.item()
+
+            eval_loss = eval(net, testloader, device, criterion, amp_dtype)
             if logger is not None:
                 logger.log_eval_loss(i+1, eval_loss)
             progbar.set_postfix({'loss': '%.3g' % (running_loss / (i+1)), 'eval_loss': '%.3g' % eval_loss})